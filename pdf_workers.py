@@ -0,0 +1,47 @@
+"""Process pool workers for PDF extraction.
+
+Kept out of streamlit_app.py because Streamlit runs the app script as
+__main__, which worker processes cannot look functions up in.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pymupdf  # PyMuPDF
+
+# Document opened once per worker process by init_worker
+_doc = None
+
+# Below this many tasks, working in-process beats starting a pool
+POOL_MIN_TASKS = 8
+
+# Forking the threaded Streamlit server can deadlock; Windows has no forkserver
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def init_worker(pdf_path):
+    """Open the PDF once in each worker process"""
+    global _doc
+    _doc = pymupdf.open(pdf_path)
+
+
+def make_pool(pdf_path, n_tasks):
+    """Create a process pool sized for n_tasks, each worker holding the PDF open"""
+    max_workers = max(1, min(os.cpu_count() or 1, n_tasks))
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(START_METHOD),
+        initializer=init_worker,
+        initargs=(pdf_path,)
+    )
+
+
+def extract_image(doc, xref):
+    """Extract the source bytes and extension of one image xref"""
+    base_image = doc.extract_image(xref)
+    return base_image["image"], base_image["ext"]
+
+
+def extract_xref_image(xref):
+    """Extract one image xref from the worker's open PDF"""
+    return extract_image(_doc, xref)
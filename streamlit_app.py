@@ -1,116 +1,224 @@
 import streamlit as st
 import pymupdf  # PyMuPDF
-import pandas as pd
-from tabula import read_pdf
 from PIL import Image
+import hashlib
 import io
 import os
 import tempfile
 import zipfile
-from openpyxl import load_workbook
-from openpyxl.drawing.image import Image as ExcelImage
+import xlsxwriter
+from contextlib import contextmanager
 
+from pdf_workers import POOL_MIN_TASKS, make_pool, extract_image, extract_xref_image
 
-def extract_tables_from_pdf(pdf_path):
-    """Extract tables from PDF using tabula"""
+# Chunk size for copying uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Extraction results kept per server, and for how long
+CACHE_MAX_ENTRIES = 8
+CACHE_TTL_SECONDS = 60 * 60
+
+# Workbook options: stream rows via temp files, store URL-like text as-is
+WORKBOOK_OPTIONS = {'constant_memory': True, 'strings_to_urls': False}
+
+# Pillow formats that xlsxwriter can embed as-is
+EXCEL_IMAGE_FORMATS = {'PNG', 'JPEG', 'GIF', 'BMP'}
+
+# Image formats worth deflating when zipped
+UNCOMPRESSED_IMAGE_EXTS = {'bmp', 'pnm', 'pam'}
+
+
+@contextmanager
+def _upload_on_disk(uploaded_file):
+    """Stream an upload to a temporary file, yielding its path and SHA-256 digest"""
+    digest = hashlib.sha256()
+    uploaded_file.seek(0)
+    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+    pdf_path = tmp_file.name
     try:
-        tables = read_pdf(pdf_path, pages="all", multiple_tables=True)
-        return tables
-    except Exception as e:
-        st.error(f"Error extracting tables: {str(e)}")
-        return []
+        with tmp_file:
+            # Copy in chunks rather than materialising the whole PDF as bytes
+            for chunk in iter(lambda: uploaded_file.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                tmp_file.write(chunk)
+        yield pdf_path, digest.hexdigest()
+    finally:
+        os.unlink(pdf_path)
+
 
+def _decode_images(doc, pdf_path, placements):
+    """Decode placed images, each unique image once"""
+    # Logos and watermarks repeat across pages, so decode per xref
+    xrefs = list(dict.fromkeys(xref for _, _, xref in placements))
+    if len(xrefs) < POOL_MIN_TASKS:
+        # Too few to pay for starting workers and pickling bytes back
+        decoded = [extract_image(doc, xref) for xref in xrefs]
+    else:
+        with make_pool(pdf_path, len(xrefs)) as executor:
+            decoded = list(executor.map(extract_xref_image, xrefs))
+    seen = dict(zip(xrefs, decoded))
 
-def extract_images_from_pdf(pdf_path):
-    """Extract images from PDF using PyMuPDF"""
     images = []
-    try:
-        doc = pymupdf.open(pdf_path)
+    for page_num, img_index, xref in placements:
+        # Repeated images share the same bytes object
+        image_bytes, ext = seen[xref]
+        images.append({
+            'page': page_num + 1,
+            'index': img_index,
+            'bytes': image_bytes,
+            'ext': ext,
+            'filename': f"image_page{page_num + 1}_{img_index}.{ext}"
+        })
+    return images
+
+
+class _ExtractionErrors(Exception):
+    """Carries partial results out of the cache when extraction hit errors"""
+
+    def __init__(self, tables, images, errors):
+        super().__init__(errors)
+        self.tables = tables
+        self.images = images
+        self.errors = errors
+
+
+# Bound the cache so past uploads do not pin their images in server memory.
+# Runs with errors raise out of it, so they are never cached.
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def _process_pdf_cached(_pdf_path, pdf_digest, extract_tables, extract_images):
+    """Extract tables and images from PDF in a single pass using PyMuPDF"""
+    # Cached on pdf_digest; the leading underscore keeps _pdf_path out of the key
+    tables = []
+    placements = []
+    images = []
+    errors = []
+    with pymupdf.open(_pdf_path) as doc:
         for page_num, page in enumerate(doc):
-            for img_index, img in enumerate(page.get_images(full=True)):
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                ext = base_image["ext"]
-
-                images.append({
-                    'page': page_num + 1,
-                    'index': img_index,
-                    'bytes': image_bytes,
-                    'ext': ext,
-                    'filename': f"image_page{page_num + 1}_{img_index}.{ext}"
-                })
-        doc.close()
-        return images
-    except Exception as e:
-        st.error(f"Error extracting images: {str(e)}")
-        return []
+            # A bad page only loses its own tables or images
+            if extract_tables:
+                try:
+                    for table in page.find_tables().tables:
+                        tables.append(table.to_pandas())
+                except Exception as e:
+                    errors.append(f"Error extracting tables on page {page_num + 1}: {str(e)}")
+
+            # List image placements; this does not decode anything
+            if extract_images:
+                try:
+                    for img_index, img in enumerate(page.get_images()):
+                        placements.append((page_num, img_index, img[0]))
+                except Exception as e:
+                    errors.append(f"Error extracting images on page {page_num + 1}: {str(e)}")
+
+        try:
+            images = _decode_images(doc, _pdf_path, placements)
+        except Exception as e:
+            errors.append(f"Error extracting images: {str(e)}")
+
+    if errors:
+        raise _ExtractionErrors(tables, images, errors)
+    return tables, images
+
+
+def process_pdf(pdf_path, pdf_digest, extract_tables=True, extract_images=True):
+    """Extract tables and images from PDF, returning them with any error messages"""
+    try:
+        tables, images = _process_pdf_cached(
+            pdf_path, pdf_digest, extract_tables, extract_images)
+        return tables, images, []
+    except _ExtractionErrors as e:
+        return e.tables, e.images, e.errors
+
+
+def _table_rows(table):
+    """Yield the header and rows of a table as plain tuples"""
+    yield tuple(table.columns)
+    # Blank out missing values; xlsxwriter rejects NaN cells
+    yield from table.astype(object).where(table.notna(), None).itertuples(
+        index=False, name=None)
+
+
+def _excel_thumbnail(image_bytes):
+    """Downscale an image to fit 400x300 and return it as a stream for Excel"""
+    with Image.open(io.BytesIO(image_bytes)) as pil_img:
+        # Small images in a format Excel reads are embedded untouched, unless
+        # a non-96 DPI header would make Excel display them at another size
+        dpi = tuple(round(d) for d in pil_img.info.get('dpi', (96, 96)))
+        if (pil_img.width <= 400 and pil_img.height <= 300
+                and pil_img.format in EXCEL_IMAGE_FORMATS and dpi == (96, 96)):
+            return io.BytesIO(image_bytes)
+
+        # Shrink the embedded image itself, not just its displayed size
+        thumb_stream = io.BytesIO()
+        pil_img.thumbnail((400, 300), Image.LANCZOS)
+        if pil_img.mode == 'CMYK':
+            pil_img = pil_img.convert('RGB')
+        pil_img.save(thumb_stream, format='PNG', compress_level=6)
+    return thumb_stream
+
+
+def _write_table_sheets(workbook, tables):
+    """Write each table to its own sheet, or a placeholder sheet if there are none"""
+    if tables:
+        for i, table in enumerate(tables):
+            ws = workbook.add_worksheet(f"Table_{i+1}")
+            # Write rows directly, skipping pandas' cell formatter;
+            # constant_memory needs them in order
+            for row_num, row in enumerate(_table_rows(table)):
+                ws.write_row(row_num, 0, row)
+    else:
+        # Create empty sheet if no tables found
+        ws = workbook.add_worksheet('No_Tables')
+        ws.write_column(0, 0, ['Message', 'No tables found in PDF'])
 
 
 def create_excel_with_tables_and_images(tables, images):
-    """Create Excel file with tables and images"""
-    # Create temporary file for Excel
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
-        excel_path = tmp_file.name
-
-    # Create Excel file with tables
-    with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
-        if tables:
-            for i, table in enumerate(tables):
-                sheet_name = f"Table_{i+1}"
-                table.to_excel(writer, sheet_name=sheet_name, index=False)
-        else:
-            # Create empty sheet if no tables found
-            pd.DataFrame({'Message': ['No tables found in PDF']}).to_excel(
-                writer, sheet_name='No_Tables', index=False
-            )
-
-    # Add images to Excel if any exist
-    if images:
-        wb = load_workbook(excel_path)
-        ws = wb.create_sheet(title="Extracted_Images")
-
-        # Create temporary directory for images
-        with tempfile.TemporaryDirectory() as temp_dir:
+    """Create Excel file with tables and images, returned as bytes"""
+    buffer = io.BytesIO()
+
+    # Write tables and images in a single pass; only the finished .xlsx is in memory
+    with xlsxwriter.Workbook(buffer, WORKBOOK_OPTIONS) as workbook:
+        _write_table_sheets(workbook, tables)
+
+        # Add images to Excel if any exist
+        if images:
+            ws = workbook.add_worksheet("Extracted_Images")
+
             row = 1
             for img_data in images:
-                # Save image temporarily
-                img_path = os.path.join(temp_dir, img_data['filename'])
-                with open(img_path, "wb") as f:
-                    f.write(img_data['bytes'])
-
-                # Add image to Excel
+                # Add image to Excel, resized to fit better
                 try:
-                    excel_img = ExcelImage(img_path)
-                    # Resize image to fit better in Excel
-                    excel_img.width = min(excel_img.width, 400)
-                    excel_img.height = min(excel_img.height, 300)
-                    ws.add_image(excel_img, f"A{row}")
+                    ws.insert_image(f"A{row}", img_data['filename'], {
+                        'image_data': _excel_thumbnail(img_data['bytes'])
+                    })
 
                     # Add image info in adjacent columns
-                    ws[f"E{row}"] = f"Page {img_data['page']}, Image {img_data['index'] + 1}"
-                    ws[f"E{row + 1}"] = img_data['filename']
+                    ws.write(f"E{row}", f"Page {img_data['page']}, Image {img_data['index'] + 1}")
+                    ws.write(f"E{row + 1}", img_data['filename'])
 
                     row += 20  # Space between images
                 except Exception as e:
                     st.warning(
                         f"Could not add image {img_data['filename']} to Excel: {str(e)}")
 
-        wb.save(excel_path)
-
-    return excel_path
+    return buffer.getvalue()
 
 
 def create_images_zip(images):
-    """Create ZIP file with all extracted images"""
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp_file:
-        zip_path = tmp_file.name
+    """Create ZIP file with all extracted images, returned as bytes"""
+    buffer = io.BytesIO()
 
-    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+    # PNG/JPEG data is already compressed, so store it as-is and only
+    # deflate the uncompressed raster formats
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zip_file:
         for img_data in images:
-            zip_file.writestr(img_data['filename'], img_data['bytes'])
+            if img_data['ext'] in UNCOMPRESSED_IMAGE_EXTS:
+                zip_file.writestr(img_data['filename'], img_data['bytes'],
+                                  compress_type=zipfile.ZIP_DEFLATED)
+            else:
+                zip_file.writestr(img_data['filename'], img_data['bytes'])
 
-    return zip_path
+    return buffer.getvalue()
 
 
 def main():
@@ -132,11 +240,6 @@ def main():
     )
 
     if uploaded_file is not None:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            pdf_path = tmp_file.name
-
         st.success(f"✅ PDF uploaded successfully: {uploaded_file.name}")
 
         # Processing options
@@ -152,22 +255,28 @@ def main():
                 return
 
             with st.spinner("Processing PDF..."):
-                tables = []
-                images = []
+                steps = [name for name, selected in
+                         (("tables", extract_tables), ("images", extract_images)) if selected]
+                st.info(f"Extracting {' and '.join(steps)}...")
+
+                # Extraction results are cached on the PDF contents
+                try:
+                    with _upload_on_disk(uploaded_file) as (pdf_path, pdf_digest):
+                        tables, images, errors = process_pdf(
+                            pdf_path, pdf_digest, extract_tables, extract_images)
+                    for error in errors:
+                        st.error(error)
+                except Exception as e:
+                    st.error(f"Error processing PDF: {str(e)}")
+                    tables, images = [], []
 
-                # Extract tables
                 if extract_tables:
-                    st.info("Extracting tables...")
-                    tables = extract_tables_from_pdf(pdf_path)
                     if tables:
                         st.success(f"✅ Found {len(tables)} tables")
                     else:
                         st.warning("⚠️ No tables found")
 
-                # Extract images
                 if extract_images:
-                    st.info("Extracting images...")
-                    images = extract_images_from_pdf(pdf_path)
                     if images:
                         st.success(f"✅ Found {len(images)} images")
                     else:
@@ -204,44 +313,32 @@ def main():
                     col1, col2 = st.columns(2)
 
                     with col1:
-                        if tables or images:
-                            st.info(
-                                "Creating Excel file with tables and images...")
-                            excel_path = create_excel_with_tables_and_images(
-                                tables, images)
-
-                            with open(excel_path, "rb") as file:
-                                st.download_button(
-                                    label="📊 Download Excel File",
-                                    data=file.read(),
-                                    file_name=f"{uploaded_file.name.rsplit('.', 1)[0]}_extracted.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                                )
-
-                            # Clean up temporary Excel file
-                            os.unlink(excel_path)
+                        st.info(
+                            "Creating Excel file with tables and images...")
+                        excel_bytes = create_excel_with_tables_and_images(
+                            tables, images)
+
+                        st.download_button(
+                            label="📊 Download Excel File",
+                            data=excel_bytes,
+                            file_name=f"{uploaded_file.name.rsplit('.', 1)[0]}_extracted.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        )
 
                     with col2:
                         if images:
                             st.info("Creating ZIP file with images...")
-                            zip_path = create_images_zip(images)
-
-                            with open(zip_path, "rb") as file:
-                                st.download_button(
-                                    label="🖼️ Download Images ZIP",
-                                    data=file.read(),
-                                    file_name=f"{uploaded_file.name.rsplit('.', 1)[0]}_images.zip",
-                                    mime="application/zip"
-                                )
-
-                            # Clean up temporary ZIP file
-                            os.unlink(zip_path)
+                            zip_bytes = create_images_zip(images)
+
+                            st.download_button(
+                                label="🖼️ Download Images ZIP",
+                                data=zip_bytes,
+                                file_name=f"{uploaded_file.name.rsplit('.', 1)[0]}_images.zip",
+                                mime="application/zip"
+                            )
                 else:
                     st.error("❌ No tables or images found in the PDF")
 
-        # Clean up temporary PDF file
-        os.unlink(pdf_path)
-
     # Instructions
     with st.expander("📖 Instructions"):
         st.markdown("""
@@ -265,7 +362,7 @@ def main():
         ### Requirements:
         Make sure you have installed the required packages:
         ```bash
-        pip install streamlit tabula-py pandas openpyxl pymupdf pillow
+        pip install streamlit pandas xlsxwriter pymupdf pillow
         ```
         """)
 